@@ -1,24 +1,49 @@
 # app.py
 import os
 import json
-from datetime import datetime
+import re
+import secrets
+import sqlite3
+import tempfile
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import math # <-- Añadido para el cálculo de humedad
+import threading
+import time
+from collections import Counter
+from functools import wraps
 
 import joblib
 import numpy as np
 from scipy.interpolate import griddata
 import requests
 
-from flask import Flask, render_template, request, jsonify, url_for, redirect, session, send_from_directory
+from flask import Flask, render_template, request, jsonify, url_for, redirect, session, send_from_directory, Response, stream_with_context
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from werkzeug.middleware.proxy_fix import ProxyFix
+from itsdangerous import Signer, BadSignature
 # --- Importaciones de tus amigos (SE MANTIENEN) ---
 import mysql.connector
 import bcrypt
 
+# --- Backend compartido (opcional) para el limitador de peticiones ---
+try:
+    import redis
+except ImportError:
+    redis = None
+
 # ---------------- 1. CONFIGURACIÓN ----------------
 app = Flask(__name__)
 
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'mi_clave_secreta_super_segura')
 
+# --- Detrás de gunicorn + proxy inverso: número de proxies de confianza delante de la app ---
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
 # --- ¡CORREGIDO! Usamos el nombre del modelo completo ---
 MODEL_FILE = 'datos_climaticos_completos.pkl'
 agente_climatico = None
@@ -136,6 +161,184 @@ def obtener_ubicacion_osm(latitud, longitud):
     except Exception:
         return "Error de API", "N/A"
 
+# ---------------- 3.5. LIMITADOR DE PETICIONES, COALESCENCIA Y MÉTRICAS ----------------
+
+# Presupuesto por ruta: (capacidad del bucket, tokens recargados por segundo).
+# Se puede ajustar con variables de entorno, ej. RATE_LIMIT_DAILY_CHART="5,0.1".
+LIMITES_POR_RUTA = {
+    'daily_chart': (5, 5 / 60),     # ráfaga de 5, luego 5 por minuto
+    'chatbot_logic': (10, 10 / 60), # ráfaga de 10, luego 10 por minuto
+}
+for _ruta in LIMITES_POR_RUTA:
+    _valor = os.environ.get(f"RATE_LIMIT_{_ruta.upper()}")
+    if _valor:
+        try:
+            _capacidad, _tasa = (float(x) for x in _valor.split(','))
+            if not (_capacidad >= 1 and _tasa > 0 and math.isfinite(_capacidad) and math.isfinite(_tasa)):
+                raise ValueError("se requiere capacidad >= 1 y tasa > 0")
+            LIMITES_POR_RUTA[_ruta] = (_capacidad, _tasa)
+        except ValueError as e:
+            print(f"❌ ADVERTENCIA: RATE_LIMIT_{_ruta.upper()}='{_valor}' inválido ({e}). Se usa el valor por defecto {LIMITES_POR_RUTA[_ruta]}.")
+
+# --- Métricas simples en memoria (contadores por nombre) ---
+metricas = Counter()
+_metricas_lock = threading.Lock()
+
+def contar(nombre, cantidad=1):
+    """Incrementa un contador de métricas de forma segura entre hilos."""
+    with _metricas_lock:
+        metricas[nombre] += cantidad
+
+class LimitadorMemoria:
+    """Token bucket en memoria del proceso, una cubeta por clave."""
+    INTERVALO_LIMPIEZA = 60  # segundos entre barridos de cubetas inactivas
+
+    def __init__(self):
+        self._cubetas = {}
+        self._lock = threading.Lock()
+        self._ultima_limpieza = time.monotonic()
+
+    def _limpiar(self, ahora):
+        """Elimina las cubetas que ya se recargaron por completo (equivalen a una nueva)."""
+        self._cubetas = {
+            clave: (tokens, ultimo, capacidad, tasa)
+            for clave, (tokens, ultimo, capacidad, tasa) in self._cubetas.items()
+            if tokens + (ahora - ultimo) * tasa < capacidad
+        }
+        self._ultima_limpieza = ahora
+
+    def consumir(self, clave, capacidad, tasa):
+        """Devuelve (permitido, segundos_de_espera)."""
+        ahora = time.monotonic()
+        with self._lock:
+            if ahora - self._ultima_limpieza >= self.INTERVALO_LIMPIEZA:
+                self._limpiar(ahora)
+            tokens, ultimo, _, _ = self._cubetas.get(clave, (capacidad, ahora, capacidad, tasa))
+            tokens = min(capacidad, tokens + (ahora - ultimo) * tasa)
+            if tokens >= 1:
+                self._cubetas[clave] = (tokens - 1, ahora, capacidad, tasa)
+                return True, 0
+            self._cubetas[clave] = (tokens, ahora, capacidad, tasa)
+            return False, (1 - tokens) / tasa
+
+class LimitadorRedis:
+    """Token bucket compartido entre procesos/workers usando Redis."""
+    SCRIPT = """
+    local capacidad = tonumber(ARGV[1])
+    local tasa = tonumber(ARGV[2])
+    local ahora = tonumber(ARGV[3])
+    local datos = redis.call('HMGET', KEYS[1], 'tokens', 'ultimo')
+    local tokens = tonumber(datos[1]) or capacidad
+    local ultimo = tonumber(datos[2]) or ahora
+    tokens = math.min(capacidad, tokens + (ahora - ultimo) * tasa)
+    local permitido = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        permitido = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ultimo', ahora)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacidad / tasa) + 1)
+    return {permitido, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        # Timeouts cortos: si Redis no responde, mejor fallar rápido que bloquear la petición
+        self._cliente = redis.Redis.from_url(url, socket_connect_timeout=0.5, socket_timeout=0.5)
+        self._cliente.ping()
+        self._script = self._cliente.register_script(self.SCRIPT)
+
+    def consumir(self, clave, capacidad, tasa):
+        permitido, tokens = self._script(keys=[f"ratelimit:{clave}"], args=[capacidad, tasa, time.time()])
+        if permitido:
+            return True, 0
+        return False, (1 - float(tokens)) / tasa
+
+def crear_limitador():
+    """Usa Redis si RATE_LIMIT_REDIS_URL está definido; si no, memoria local."""
+    url = os.environ.get('RATE_LIMIT_REDIS_URL')
+    if url and redis is not None:
+        try:
+            limitador = LimitadorRedis(url)
+            print("✅ Limitador de peticiones usando Redis compartido.")
+            return limitador
+        except Exception as e:
+            print(f"❌ ADVERTENCIA: No se pudo usar Redis para el limitador ({e}). Se usará memoria local.")
+    elif url:
+        print("❌ ADVERTENCIA: RATE_LIMIT_REDIS_URL definido pero el paquete 'redis' no está instalado. Se usará memoria local.")
+    return LimitadorMemoria()
+
+limitador = crear_limitador()
+
+def clave_cliente():
+    """
+    Identifica al cliente por el usuario en sesión o, si no hay, por su IP.
+    Detrás de un proxy inverso, define TRUSTED_PROXIES para que remote_addr
+    sea la IP real del cliente (X-Forwarded-For) y no la del proxy.
+    """
+    if 'usuario' in session:
+        return f"usuario:{session['usuario']}"
+    return f"ip:{request.remote_addr}"
+
+def limitar(ruta):
+    """Decorador que aplica el presupuesto de LIMITES_POR_RUTA[ruta] a la vista."""
+    capacidad, tasa = LIMITES_POR_RUTA[ruta]
+    def decorador(vista):
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            try:
+                permitido, espera = limitador.consumir(f"{ruta}:{clave_cliente()}", capacidad, tasa)
+            except Exception as e:
+                # Si el backend compartido falla, no bloqueamos al usuario
+                print(f"❌ Error en el limitador de peticiones: {e}")
+                contar(f"limitador.error.{ruta}")
+                return vista(*args, **kwargs)
+            if not permitido:
+                contar(f"limitador.rechazado.{ruta}")
+                segundos = max(1, math.ceil(espera))
+                respuesta = jsonify({'error': 'Demasiadas solicitudes. Inténtalo más tarde.', 'retry_after': segundos})
+                respuesta.status_code = 429
+                respuesta.headers['Retry-After'] = str(segundos)
+                return respuesta
+            contar(f"limitador.permitido.{ruta}")
+            return vista(*args, **kwargs)
+        return envoltura
+    return decorador
+
+class Coalescedor:
+    """Agrupa llamadas idénticas en curso para que compartan un solo cálculo."""
+    def __init__(self):
+        self._en_curso = {}
+        self._lock = threading.Lock()
+
+    def ejecutar(self, clave, funcion, *args):
+        with self._lock:
+            entrada = self._en_curso.get(clave)
+            es_lider = entrada is None
+            if es_lider:
+                entrada = {'evento': threading.Event(), 'resultado': None, 'error': None}
+                self._en_curso[clave] = entrada
+
+        if not es_lider:
+            contar("coalescencia.compartida")
+            entrada['evento'].wait()
+            if entrada['error'] is not None:
+                raise entrada['error']
+            return entrada['resultado']
+
+        contar("coalescencia.calculada")
+        try:
+            entrada['resultado'] = funcion(*args)
+            return entrada['resultado']
+        except Exception as e:
+            entrada['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._en_curso.pop(clave, None)
+            entrada['evento'].set()
+
+coalescedor = Coalescedor()
+
 # ---------------- 4. CONEXIÓN Y ESTRUCTURA DE BASE DE DATOS ----------------
 def conectar(con_db=True):
     db_config = {"host": "localhost", "user": "root", "password": ""}
@@ -181,6 +384,245 @@ def inicializar_db():
         print("✅ Base de datos y tablas verificadas/creadas.")
     except Exception as e:
         print(f"❌ Error al inicializar la base de datos: {e}")
+# ---------------- 4.5. SESIONES EN SERVIDOR E IDENTIDAD DE USUARIO ----------------
+
+# SESSION_BACKEND: 'cookie' (por defecto, sesión firmada de Flask), 'filesystem' o 'sqlite'
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'cookie')
+SESSION_LIFETIME = int(os.environ.get('SESSION_LIFETIME', 7 * 24 * 3600))  # segundos
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))  # segundos
+
+class SesionServidor(CallbackDict, SessionMixin):
+    """Sesión cuyo contenido vive en el servidor; la cookie solo guarda el id."""
+    def __init__(self, datos=None, sid=None, nueva=False):
+        def al_modificar(sesion):
+            sesion.modified = True
+        super().__init__(datos, al_modificar)
+        self.sid = sid
+        self.new = nueva
+        self.modified = False
+
+class AlmacenSesionesArchivos:
+    """Guarda cada sesión como un archivo JSON dentro de un directorio."""
+    INTERVALO_LIMPIEZA = 300  # segundos entre barridos de sesiones vencidas
+
+    def __init__(self, directorio):
+        self.directorio = directorio
+        os.makedirs(directorio, exist_ok=True)
+        self._ultima_limpieza = 0
+        self._lock = threading.Lock()
+
+    def _ruta(self, sid):
+        return os.path.join(self.directorio, f"{sid}.json")
+
+    def cargar(self, sid):
+        try:
+            with open(self._ruta(sid), encoding='utf-8') as f:
+                registro = json.load(f)
+            vencida = registro['expira'] < time.time()
+            datos = registro['datos']
+        except (OSError, ValueError, KeyError, TypeError):
+            # Archivo ilegible o corrupto: se trata como sesión inexistente
+            return None
+        if vencida:
+            self.borrar(sid)
+            return None
+        return datos
+
+    def guardar(self, sid, datos, expira):
+        # Archivo temporal único: peticiones concurrentes de la misma sesión no se pisan
+        descriptor, temporal = tempfile.mkstemp(dir=self.directorio, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+                json.dump({'datos': datos, 'expira': expira}, f)
+            os.replace(temporal, self._ruta(sid))
+        except BaseException:
+            try:
+                os.remove(temporal)
+            except OSError:
+                pass
+            raise
+        self._limpiar_vencidas()
+
+    def _limpiar_vencidas(self):
+        """Borra periódicamente los archivos de sesiones abandonadas y vencidas."""
+        ahora = time.time()
+        with self._lock:
+            if ahora - self._ultima_limpieza < self.INTERVALO_LIMPIEZA:
+                return
+            self._ultima_limpieza = ahora
+        for entrada in os.scandir(self.directorio):
+            if not entrada.name.endswith('.json'):
+                continue
+            try:
+                with open(entrada.path, encoding='utf-8') as f:
+                    vencida = json.load(f)['expira'] < ahora
+            except (OSError, ValueError, KeyError, TypeError):
+                vencida = True
+            if vencida:
+                self.borrar(entrada.name[:-len('.json')])
+
+    def borrar(self, sid):
+        try:
+            os.remove(self._ruta(sid))
+        except OSError:
+            pass
+
+class AlmacenSesionesSQLite:
+    """Guarda las sesiones en una tabla SQLite con fecha de expiración."""
+    def __init__(self, ruta_db):
+        self.ruta_db = ruta_db
+        with closing(sqlite3.connect(self.ruta_db)) as conexion, conexion:
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS sesiones (sid TEXT PRIMARY KEY, datos TEXT NOT NULL, expira REAL NOT NULL)"
+            )
+
+    def cargar(self, sid):
+        with closing(sqlite3.connect(self.ruta_db)) as conexion:
+            fila = conexion.execute(
+                "SELECT datos FROM sesiones WHERE sid = ? AND expira >= ?", (sid, time.time())
+            ).fetchone()
+        return json.loads(fila[0]) if fila else None
+
+    def guardar(self, sid, datos, expira):
+        # closing() cierra la conexión; el segundo "with" hace commit/rollback
+        with closing(sqlite3.connect(self.ruta_db)) as conexion, conexion:
+            conexion.execute(
+                "INSERT OR REPLACE INTO sesiones (sid, datos, expira) VALUES (?, ?, ?)",
+                (sid, json.dumps(datos), expira)
+            )
+            # Limpieza de sesiones vencidas aprovechando la misma transacción
+            conexion.execute("DELETE FROM sesiones WHERE expira < ?", (time.time(),))
+
+    def borrar(self, sid):
+        with closing(sqlite3.connect(self.ruta_db)) as conexion, conexion:
+            conexion.execute("DELETE FROM sesiones WHERE sid = ?", (sid,))
+
+class InterfazSesionServidor(SessionInterface):
+    """Conecta un almacén de sesiones con Flask usando una cookie firmada con el id."""
+    def __init__(self, almacen, duracion):
+        self.almacen = almacen
+        self.duracion = duracion
+
+    def _firmador(self, app):
+        return Signer(app.secret_key, salt='sesion-servidor')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._firmador(app).unsign(cookie).decode('utf-8')
+            except BadSignature:
+                sid = None
+            if sid:
+                datos = self.almacen.cargar(sid)
+                if datos is not None:
+                    return SesionServidor(datos, sid=sid)
+        return SesionServidor(sid=secrets.token_urlsafe(32), nueva=True)
+
+    def save_session(self, app, session, response):
+        nombre = self.get_cookie_name(app)
+        dominio = self.get_cookie_domain(app)
+        ruta = self.get_cookie_path(app)
+
+        # Igual que la sesión de Flask: la respuesta depende de la cookie
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            # Sesión vaciada (ej. logout): se borra del servidor y del navegador
+            if session.modified:
+                self.almacen.borrar(session.sid)
+                response.delete_cookie(nombre, domain=dominio, path=ruta)
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        expira = time.time() + self.duracion
+        self.almacen.guardar(session.sid, dict(session), expira)
+        response.set_cookie(
+            nombre,
+            self._firmador(app).sign(session.sid).decode('utf-8'),
+            max_age=self.duracion,
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            domain=dominio,
+            path=ruta,
+        )
+
+if SESSION_BACKEND == 'filesystem':
+    app.session_interface = InterfazSesionServidor(
+        AlmacenSesionesArchivos(os.environ.get('SESSION_DIR', 'sesiones')), SESSION_LIFETIME
+    )
+elif SESSION_BACKEND == 'sqlite':
+    app.session_interface = InterfazSesionServidor(
+        AlmacenSesionesSQLite(os.environ.get('SESSION_SQLITE_PATH', 'sesiones.db')), SESSION_LIFETIME
+    )
+
+class CacheUsuarios:
+    """Caché pequeña con TTL de registros de usuario (sin la contraseña)."""
+    def __init__(self, ttl, maximo=1024):
+        self.ttl = ttl
+        self.maximo = maximo
+        self._datos = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, username):
+        with self._lock:
+            entrada = self._datos.get(username)
+            if entrada is None:
+                return None
+            expira, registro = entrada
+            if expira < time.monotonic():
+                del self._datos[username]
+                return None
+            return registro
+
+    def guardar(self, username, registro):
+        with self._lock:
+            if len(self._datos) >= self.maximo:
+                self._datos.clear()
+            self._datos[username] = (time.monotonic() + self.ttl, {'id': registro['id'], 'username': registro['username']})
+
+    def invalidar(self, username):
+        with self._lock:
+            self._datos.pop(username, None)
+
+cache_usuarios = CacheUsuarios(USER_CACHE_TTL)
+
+def regenerar_sesion():
+    """
+    Vacía la sesión y, si vive en el servidor, le asigna un sid nuevo.
+    Se llama al iniciar sesión para evitar la fijación de sesión.
+    """
+    session.clear()
+    if isinstance(session, SesionServidor):
+        app.session_interface.almacen.borrar(session.sid)
+        session.sid = secrets.token_urlsafe(32)
+        session.modified = True
+
+def obtener_usuario_id(cursor):
+    """
+    Devuelve el id del usuario en sesión. Primero usa session['usuario_id'],
+    luego la caché y, solo como último recurso, consulta la base de datos.
+    """
+    usuario_id = session.get('usuario_id')
+    if usuario_id is not None:
+        return usuario_id
+
+    registro = cache_usuarios.obtener(session['usuario'])
+    if registro is None:
+        cursor.execute("SELECT id, username FROM usuarios WHERE username = %s", (session['usuario'],))
+        registro = cursor.fetchone()
+        if not registro:
+            return None
+        cache_usuarios.guardar(session['usuario'], registro)
+
+    # Sesiones creadas antes de guardar el id: se completa para las próximas peticiones
+    session['usuario_id'] = registro['id']
+    return registro['id']
+
 # ---------------- 5. RUTAS DE LA APLICACIÓN WEB ----------------
 
 # Rutas para las páginas principales (CÓDIGO DE TUS AMIGOS)
@@ -276,11 +718,8 @@ def get_climate_data():
     })
 
 # --- API para el gráfico diario (FUNCIONALIDAD AÑADIDA) ---
-@app.route('/api/daily_chart', methods=['POST'])
-def daily_chart():
-    data = request.json
-    lat, lon, date = data.get('latitude'), data.get('longitude'), data.get('date')
-
+def calcular_grafico_diario(lat, lon, date):
+    """Calcula las 24 horas del pronóstico para el gráfico diario."""
     horas = [f"{h:02d}:00" for h in range(24)]
     temperaturas, puntos_rocio, precipitaciones = [], [], []
 
@@ -294,12 +733,22 @@ def daily_chart():
         puntos_rocio.append(hum if hum is not None else None)
         precipitaciones.append(prec if prec is not None else 0)
 
-    return jsonify({
+    return {
         'labels': horas,
         'temperatures': temperaturas,
         'humidities': puntos_rocio,
         'precipitations': precipitaciones
-    })
+    }
+
+@app.route('/api/daily_chart', methods=['POST'])
+@limitar('daily_chart')
+def daily_chart():
+    data = request.json
+    lat, lon, date = data.get('latitude'), data.get('longitude'), data.get('date')
+
+    # Peticiones idénticas en curso comparten el mismo cálculo
+    grafico = coalescedor.ejecutar(('daily_chart', lat, lon, date), calcular_grafico_diario, lat, lon, date)
+    return jsonify(grafico)
 
 # --- ¡NUEVA API AÑADIDA! Para la página de comparación ---
 @app.route('/api/get_comparison_data', methods=['POST'])
@@ -370,11 +819,9 @@ def agendar_evento():
         conexion = conectar()
         cursor = conexion.cursor(dictionary=True)
         
-        cursor.execute("SELECT id FROM usuarios WHERE username = %s", (session['usuario'],))
-        user = cursor.fetchone()
-        if not user:
+        usuario_id = obtener_usuario_id(cursor)
+        if usuario_id is None:
             return jsonify({'error': 'Usuario no encontrado en la base de datos.'}), 404
-        usuario_id = user['id']
 
         insert_cursor = conexion.cursor()
         sql_query = "INSERT INTO eventos (usuario_id, titulo, descripcion, fecha_evento) VALUES (%s, %s, %s, %s)"
@@ -402,12 +849,10 @@ def get_events():
     try:
         conexion = conectar()
         cursor = conexion.cursor(dictionary=True)
-        # Obtenemos el ID del usuario actual
-        cursor.execute("SELECT id FROM usuarios WHERE username = %s", (session['usuario'],))
-        user = cursor.fetchone()
-        if not user:
+        # Obtenemos el ID del usuario actual (sesión o caché, sin consultar la DB)
+        user_id = obtener_usuario_id(cursor)
+        if user_id is None:
             return jsonify({'error': 'Usuario no encontrado'}), 404
-        user_id = user['id']
 
         # Buscamos todos los eventos de ese usuario
         cursor.execute("SELECT lugar, fecha_hora, descripcion FROM eventos WHERE user_id = %s", (user_id,))
@@ -443,11 +888,9 @@ def obtener_eventos():
         cursor = conexion.cursor(dictionary=True)
         
         # 1. Obtener el ID del usuario actual de la sesión
-        cursor.execute("SELECT id FROM usuarios WHERE username = %s", (session['usuario'],))
-        user = cursor.fetchone()
-        if not user:
+        usuario_id = obtener_usuario_id(cursor)
+        if usuario_id is None:
             return jsonify({'error': 'Usuario no encontrado'}), 404
-        usuario_id = user['id']
 
         # 2. Buscar todos los eventos de ese usuario en la base de datos
         cursor.execute("SELECT titulo, descripcion, fecha_evento FROM eventos WHERE usuario_id = %s", (usuario_id,))
@@ -474,6 +917,310 @@ def obtener_eventos():
     finally:
         if conexion:
             conexion.close()
+# --- IMPORTACIÓN / EXPORTACIÓN MASIVA DE EVENTOS ---
+TAMANO_LOTE = 500  # filas por executemany / fetchmany
+
+def desescapar_ics(valor):
+    """Revierte el escapado de texto de iCalendar (RFC 5545)."""
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) in 'nN' else m.group(1), valor)
+
+def escapar_ics(valor):
+    """Escapa texto para una propiedad de iCalendar."""
+    return (valor.replace('\\', '\\\\').replace(';', '\\;')
+                 .replace(',', '\\,').replace('\r\n', '\\n').replace('\r', '\\n').replace('\n', '\\n'))
+
+def plegar_linea_ics(linea):
+    """Pliega una línea de contenido a 75 octetos (RFC 5545) sin partir caracteres UTF-8."""
+    partes, actual, octetos, limite = [], [], 0, 75
+    for caracter in linea:
+        tamano = len(caracter.encode('utf-8'))
+        if octetos + tamano > limite:
+            partes.append(''.join(actual))
+            # Las líneas de continuación empiezan con un espacio, que también cuenta
+            actual, octetos, limite = [], 0, 74
+        actual.append(caracter)
+        octetos += tamano
+    partes.append(''.join(actual))
+    return '\r\n '.join(partes) + '\r\n'
+
+# Zona horaria en la que se guardan las fechas de los eventos (DATETIME sin zona)
+try:
+    ZONA_HORARIA_APP = ZoneInfo(os.environ.get('APP_TIMEZONE', 'America/Lima'))
+except (ZoneInfoNotFoundError, ValueError):
+    # Sin base de datos de zonas (instalar 'tzdata') o APP_TIMEZONE mal escrito.
+    # Lima no tiene horario de verano, así que UTC-5 fijo es equivalente.
+    print(f"❌ ADVERTENCIA: Zona horaria '{os.environ.get('APP_TIMEZONE', 'America/Lima')}' no disponible. Se usará UTC-5 fijo.")
+    ZONA_HORARIA_APP = timezone(timedelta(hours=-5), 'UTC-05')
+
+def convertir_dtstart_ics(valor, parametros):
+    """
+    Convierte un DTSTART de iCalendar a (fecha, hora) en la zona horaria de la app.
+    Las horas en UTC (sufijo Z) o con TZID se convierten; las horas "flotantes" se
+    toman tal cual. Lanza ValueError si el valor o la zona horaria no son válidos.
+    """
+    valor = valor.strip()
+    if parametros.get('VALUE', '').upper() == 'DATE' or len(valor) == 8:
+        # Eventos de día completo (solo fecha) se agendan a las 00:00
+        fecha = datetime.strptime(valor[:8], '%Y%m%d')
+        return fecha.strftime('%Y-%m-%d'), "00:00"
+
+    es_utc = valor.upper().endswith('Z')
+    fecha = datetime.strptime(valor.rstrip('Zz'), '%Y%m%dT%H%M%S')
+    if es_utc:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    elif 'TZID' in parametros:
+        try:
+            fecha = fecha.replace(tzinfo=ZoneInfo(parametros['TZID']))
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"Zona horaria desconocida: {parametros['TZID']}")
+    if fecha.tzinfo is not None:
+        fecha = fecha.astimezone(ZONA_HORARIA_APP)
+    return fecha.strftime('%Y-%m-%d'), fecha.strftime('%H:%M')
+
+def leer_eventos_ics(texto):
+    """
+    Convierte los VEVENT de un archivo .ics en filas {titulo, fecha, hora, descripcion}.
+    Si un DTSTART no se puede interpretar, la fila lleva 'error_ics' con el motivo.
+    """
+    # Las líneas que empiezan con espacio o tabulación continúan la anterior
+    lineas = []
+    for linea in texto.splitlines():
+        if linea[:1] in (' ', '\t') and lineas:
+            lineas[-1] += linea[1:]
+        else:
+            lineas.append(linea)
+
+    filas, actual = [], None
+    anidados = 0  # componentes dentro del VEVENT actual (ej. VALARM)
+    for linea in lineas:
+        if ':' not in linea:
+            continue
+        nombre, valor = linea.split(':', 1)
+        nombre, *resto = nombre.split(';')
+        nombre = nombre.upper()
+        componente = valor.strip().upper()
+
+        if nombre == 'BEGIN':
+            if actual is not None:
+                anidados += 1
+            elif componente == 'VEVENT':
+                actual, anidados = {}, 0
+        elif nombre == 'END':
+            if actual is not None and anidados > 0:
+                anidados -= 1
+            elif actual is not None and componente == 'VEVENT':
+                filas.append(actual)
+                actual = None
+        elif actual is not None and anidados == 0:
+            # Las propiedades de componentes anidados (VALARM) no son del evento
+            if nombre == 'SUMMARY':
+                actual['titulo'] = desescapar_ics(valor)
+            elif nombre == 'DESCRIPTION':
+                actual['descripcion'] = desescapar_ics(valor)
+            elif nombre == 'DTSTART':
+                parametros = {}
+                for parametro in resto:
+                    clave, _, contenido = parametro.partition('=')
+                    parametros[clave.upper()] = contenido.strip('"')
+                try:
+                    actual['fecha'], actual['hora'] = convertir_dtstart_ics(valor, parametros)
+                except ValueError as e:
+                    actual['error_ics'] = f"DTSTART inválido ({valor}): {e}"
+    return filas
+
+def validar_evento(fila):
+    """Devuelve (titulo, descripcion, fecha_evento) o lanza ValueError con el motivo."""
+    if not isinstance(fila, dict):
+        raise ValueError('La fila no es un objeto.')
+    if 'error_ics' in fila:
+        raise ValueError(fila['error_ics'])
+    titulo = fila.get('titulo')
+    fecha = fila.get('fecha')
+    hora = fila.get('hora')
+    descripcion = fila.get('descripcion') or ''
+    if not all([titulo, fecha, hora]):
+        raise ValueError('Faltan titulo, fecha u hora.')
+    if not all(isinstance(v, str) for v in (titulo, fecha, hora, descripcion)):
+        raise ValueError('titulo, fecha, hora y descripcion deben ser texto.')
+    if len(titulo) > 255:
+        raise ValueError('El título supera los 255 caracteres.')
+    if len(descripcion.encode('utf-8')) > 65535:
+        raise ValueError('La descripción supera el tamaño máximo (65535 bytes).')
+    if len(hora.split(':')) == 2: hora += ":00"
+    try:
+        fecha_evento = datetime.strptime(f"{fecha} {hora}", '%Y-%m-%d %H:%M:%S')
+    except (ValueError, TypeError):
+        raise ValueError(f"Formato de fecha/hora inválido: {fecha} {hora}")
+    return titulo, descripcion, fecha_evento
+
+@app.route('/api/importar_eventos', methods=['POST'])
+def importar_eventos():
+    if 'usuario' not in session:
+        return jsonify({'error': 'No autorizado'}), 401
+
+    # 1. Leer las filas desde el archivo subido (.ics o .json) o del cuerpo JSON
+    archivo = request.files.get('archivo')
+    try:
+        if archivo:
+            texto = archivo.read().decode('utf-8-sig')
+            if archivo.filename.lower().endswith('.ics') or texto.lstrip().startswith('BEGIN:VCALENDAR'):
+                filas = leer_eventos_ics(texto)
+            else:
+                filas = json.loads(texto)
+        else:
+            filas = request.get_json(silent=True)
+        if isinstance(filas, dict):
+            filas = filas.get('eventos')
+        if not isinstance(filas, list):
+            raise ValueError('Se esperaba una lista de eventos.')
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'error': f'Archivo inválido: {e}'}), 400
+
+    # 2. Validar fila por fila; las inválidas se reportan y no se insertan
+    validas, errores = [], []
+    for indice, fila in enumerate(filas):
+        try:
+            validas.append(validar_evento(fila))
+        except ValueError as e:
+            errores.append({'fila': indice, 'error': str(e)})
+
+    inicio = time.perf_counter()
+    conexion = None
+    try:
+        conexion = conectar()
+        cursor = conexion.cursor(dictionary=True)
+        usuario_id = obtener_usuario_id(cursor)
+        cursor.close()
+        if usuario_id is None:
+            return jsonify({'error': 'Usuario no encontrado'}), 404
+
+        # 3. Insertar por lotes dentro de una sola transacción
+        insert_cursor = conexion.cursor()
+        sql_query = "INSERT INTO eventos (usuario_id, titulo, descripcion, fecha_evento) VALUES (%s, %s, %s, %s)"
+        for i in range(0, len(validas), TAMANO_LOTE):
+            lote = [(usuario_id,) + evento for evento in validas[i:i + TAMANO_LOTE]]
+            insert_cursor.executemany(sql_query, lote)
+        conexion.commit()
+        insert_cursor.close()
+    except Exception as e:
+        if conexion: conexion.rollback()
+        print(f"❌ Error al importar eventos: {e}")
+        return jsonify({'error': 'Error en el servidor al importar los eventos.'}), 500
+    finally:
+        if conexion:
+            conexion.close()
+
+    segundos = time.perf_counter() - inicio
+    filas_por_segundo = len(validas) / segundos if segundos > 0 else None
+    contar("importacion.filas", len(validas))
+    contar("importacion.errores", len(errores))
+    print(f"✅ Importación: {len(validas)} eventos en {segundos:.3f}s ({filas_por_segundo or 0:.0f} filas/s)")
+
+    return jsonify({
+        'insertados': len(validas),
+        'errores': errores,
+        'segundos': round(segundos, 3),
+        'filas_por_segundo': round(filas_por_segundo, 1) if filas_por_segundo else None
+    }), 201 if validas else 200
+
+@app.route('/api/exportar_eventos', methods=['GET'])
+def exportar_eventos():
+    if 'usuario' not in session:
+        return jsonify({'error': 'No autorizado'}), 401
+
+    formato = request.args.get('formato', 'ics').lower()
+    if formato not in ('ics', 'ndjson'):
+        return jsonify({'error': "Formato no soportado. Usa 'ics' o 'ndjson'."}), 400
+
+    conexion = None
+    transmitiendo = False  # una vez creada la respuesta, la conexión se cierra al terminarla
+    try:
+        conexion = conectar()
+        cursor = conexion.cursor(dictionary=True)
+        usuario_id = obtener_usuario_id(cursor)
+        cursor.close()
+        if usuario_id is None:
+            return jsonify({'error': 'Usuario no encontrado'}), 404
+        transmitiendo = True
+    except Exception as e:
+        print(f"❌ Error al exportar eventos: {e}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if conexion and not transmitiendo:
+            conexion.close()
+
+    cerrada = False
+
+    def cerrar_conexion():
+        # Idempotente: la llaman generar() y la respuesta al cerrarse (HEAD, cliente
+        # desconectado antes del primer bloque), y solo la primera llamada cierra.
+        nonlocal cerrada
+        if not cerrada:
+            cerrada = True
+            try:
+                conexion.close()
+            except mysql.connector.Error as e:
+                print(f"❌ Error al cerrar la conexión de exportación: {e}")
+
+    def generar():
+        # Cursor sin buffer: las filas se leen del servidor por lotes, sin cargarlas todas en memoria
+        inicio = time.perf_counter()
+        total = 0
+        cursor = None
+        try:
+            cursor = conexion.cursor(dictionary=True, buffered=False)
+            cursor.execute("SELECT id, titulo, descripcion, fecha_evento FROM eventos WHERE usuario_id = %s ORDER BY fecha_evento", (usuario_id,))
+            if formato == 'ics':
+                yield "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//EcoWeather//Agenda//ES\r\n"
+            marca = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+            while True:
+                lote = cursor.fetchmany(TAMANO_LOTE)
+                if not lote:
+                    break
+                partes = []
+                for evento in lote:
+                    if formato == 'ics':
+                        partes.append("BEGIN:VEVENT\r\n")
+                        partes.append(f"UID:evento-{evento['id']}@ecoweather\r\n")
+                        partes.append(f"DTSTAMP:{marca}\r\n")
+                        partes.append(f"DTSTART:{evento['fecha_evento'].strftime('%Y%m%dT%H%M%S')}\r\n")
+                        partes.append(plegar_linea_ics(f"SUMMARY:{escapar_ics(evento['titulo'])}"))
+                        partes.append(plegar_linea_ics(f"DESCRIPTION:{escapar_ics(evento['descripcion'] or '')}"))
+                        partes.append("END:VEVENT\r\n")
+                    else:
+                        partes.append(json.dumps({
+                            'id': evento['id'],
+                            'titulo': evento['titulo'],
+                            'descripcion': evento['descripcion'],
+                            'fecha': evento['fecha_evento'].strftime('%Y-%m-%d'),
+                            'hora': evento['fecha_evento'].strftime('%H:%M')
+                        }, ensure_ascii=False) + "\n")
+                total += len(lote)
+                yield "".join(partes)
+            if formato == 'ics':
+                yield "END:VCALENDAR\r\n"
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except mysql.connector.Error:
+                    # Cliente desconectado a mitad de la descarga: quedan filas sin leer
+                    pass
+            cerrar_conexion()
+            segundos = time.perf_counter() - inicio
+            contar("exportacion.filas", total)
+            print(f"✅ Exportación ({formato}): {total} eventos en {segundos:.3f}s ({total / segundos if segundos > 0 else 0:.0f} filas/s)")
+
+    if formato == 'ics':
+        tipo, nombre = 'text/calendar; charset=utf-8', 'agenda.ics'
+    else:
+        tipo, nombre = 'application/x-ndjson; charset=utf-8', 'agenda.ndjson'
+    respuesta = Response(stream_with_context(generar()), content_type=tipo,
+                         headers={'Content-Disposition': f'attachment; filename={nombre}'})
+    # Si generar() nunca llega a ejecutarse, la conexión se cierra igual con la respuesta
+    respuesta.call_on_close(cerrar_conexion)
+    return respuesta
+
 # --- Rutas de Autenticación de Usuarios (CORREGIDAS Y UNIFICADAS) ---
 @app.route('/login', methods=['POST'])
 def login():
@@ -497,8 +1244,11 @@ def login():
             stored_bytes = stored.encode('utf-8') if isinstance(stored, str) else stored
 
             if bcrypt.checkpw(contraseña.encode('utf-8'), stored_bytes):
-                # --- Guardamos usuario en sesión ---
+                # --- Guardamos usuario en sesión (con un sid nuevo) ---
+                regenerar_sesion()
                 session['usuario'] = usuario
+                session['usuario_id'] = usuario_db['id']
+                cache_usuarios.guardar(usuario, usuario_db)
                 mensaje = f"✅ Bienvenido, {usuario}"
                 # Redirigir al perfil si quieres que inicie sesión automáticamente
                 return redirect(url_for('inicio'))
@@ -581,6 +1331,7 @@ def actualizar_password():
                 update_cursor.execute("UPDATE usuarios SET password = %s WHERE username = %s", (hashed_nueva, usuario))
                 conexion.commit()
                 update_cursor.close()
+                cache_usuarios.invalidar(usuario)
                 mensaje = "✅ Contraseña actualizada correctamente."
             else:
                 mensaje = "❌ Contraseña actual incorrecta."
@@ -640,6 +1391,7 @@ def call_gemini_api(user_message):
         return "Recibí una respuesta inesperada del asistente."
 
 @app.route('/api/chatbot', methods=['POST'])
+@limitar('chatbot_logic')
 def chatbot_logic():
     data = request.json
     user_message = data.get('message', '').lower()
@@ -647,12 +1399,27 @@ def chatbot_logic():
     if not user_message:
         return jsonify({'response': 'Por favor, escribe un mensaje.'})
 
-    # Llama a la nueva función de Gemini
-    bot_response = call_gemini_api(user_message)
+    # Llama a la nueva función de Gemini (mensajes idénticos en curso comparten la llamada)
+    bot_response = coalescedor.ejecutar(('chatbot', user_message), call_gemini_api, user_message)
     
     # Por ahora, no redirigimos automáticamente, Gemini dará las instrucciones.
     return jsonify({'response': bot_response, 'redirect_url': None})
 
+# --- Métricas del limitador y de la coalescencia ---
+# Con METRICS_TOKEN definido se exige la cabecera X-Metrics-Token; sin él, solo acceso local.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+@app.route('/api/metricas', methods=['GET'])
+def obtener_metricas():
+    if METRICS_TOKEN:
+        autorizado = secrets.compare_digest(request.headers.get('X-Metrics-Token', ''), METRICS_TOKEN)
+    else:
+        autorizado = request.remote_addr in ('127.0.0.1', '::1')
+    if not autorizado:
+        return jsonify({'error': 'No autorizado'}), 403
+    with _metricas_lock:
+        return jsonify(dict(metricas))
+
 
 
 # ---------------- EJECUCIÓN ----------------